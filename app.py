@@ -1,13 +1,35 @@
 import os
-import json
-import base64
+import atexit
+import orjson
+import pybase64
+import logging
 import requests
 import hmac
 import hashlib
+import queue
+import threading
 import time
+from cachetools import TTLCache
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request, make_response, redirect, abort
+from logging.handlers import QueueHandler, QueueListener
+from pybloom_live import ScalableBloomFilter
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from upstash_redis import Redis
 
+# Request threads only enqueue log records; a single background thread
+# drains the queue and writes to stdout, so logging never serializes
+# workers on the write syscall.
+_log_queue = queue.Queue(-1)
+_log_listener = QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper(), handlers=[QueueHandler(_log_queue)])
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
 
 # === CONFIGURATION ===
@@ -18,9 +40,43 @@ SLACK_SIGNING_SECRET = os.environ.get("SLACK_SIGNING_SECRET")
 REDIS_URL = os.environ.get("UPSTASH_REDIS_REST_URL")
 REDIS_TOKEN = os.environ.get("UPSTASH_REDIS_REST_TOKEN")
 TILITER_URL = "https://api.ai.vision.tiliter.com/api/v1/inference/receipt-processor"
+_IMAGE_PREFIX = "image/"
+
+# Connect/read timeout for every outbound call; a hung Slack or Tiliter
+# connection must not pin an executor thread forever.
+HTTP_TIMEOUT = (3.05, 30)
+
+# Shared session so Slack/Tiliter calls reuse keep-alive connections
+# instead of paying a TCP+TLS handshake per request.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[429, 502, 503, 504])
+))
+
+# Image processing runs off the request thread so the handler can ACK
+# Slack within its 3-second retry window.
+EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("WORKERS", "16")),
+    thread_name_prefix="slackevt"
+)
+atexit.register(EXECUTOR.shutdown)
 
 redis = Redis(url=REDIS_URL, token=REDIS_TOKEN)
-processed_event_ids = set()
+
+# Event dedupe. A Bloom filter keeps memory roughly constant where the
+# old set() grew forever; a rare false positive just drops a duplicate
+# retry, which is harmless. add() can grow a new internal filter, so it
+# must not run concurrently from two request threads.
+seen_events = ScalableBloomFilter(initial_capacity=10_000, error_rate=0.001)
+SEEN_LOCK = threading.Lock()
+
+# API keys change rarely; a short-lived in-process cache skips the
+# Upstash round-trip on repeat uploads from the same user. TTLCache is
+# not thread-safe, so every access goes through the lock.
+API_KEY_CACHE = TTLCache(maxsize=2048, ttl=300)
+API_KEY_LOCK = threading.Lock()
 
 # === Slack request verification ===
 def verify_slack_request(req):
@@ -59,61 +115,93 @@ def oauth_callback():
     if not code:
         return "Missing code", 400
 
-    response = requests.post("https://slack.com/api/oauth.v2.access", data={
+    response = SESSION.post("https://slack.com/api/oauth.v2.access", data={
         "client_id": SLACK_CLIENT_ID,
         "client_secret": SLACK_CLIENT_SECRET,
         "code": code
-    })
+    }, timeout=HTTP_TIMEOUT)
+
+    # Only parse on a 200; error responses (e.g. an HTML page from a
+    # proxy) may not be JSON at all.
+    if response.status_code != 200:
+        logger.error("❌ OAuth error: %s", response.text)
+        return "OAuth failed", 400
 
-    if response.status_code != 200 or not response.json().get("ok"):
-        print("❌ OAuth error:", response.text)
+    json_resp = orjson.loads(response.content)
+    if not json_resp.get("ok"):
+        logger.error("❌ OAuth error: %s", response.text)
         return "OAuth failed", 400
 
-    json_resp = response.json()
     team_id = json_resp["team"]["id"]
     access_token = json_resp["access_token"]
 
     redis.set(f"token:{team_id}", access_token)
 
-    print(f"[METRIC] New app install: team_id={team_id}")
+    logger.info("[METRIC] New app install: team_id=%s", team_id)
     return "App installed successfully! You can now use the Tiliter bot in your Slack workspace."
 
 @app.route("/events", methods=["POST"])
 def slack_events():
     verify_slack_request(request)
-    data = request.json
+    data = orjson.loads(request.get_data())
 
     if data.get("type") == "url_verification":
         return make_response(data["challenge"], 200, {"Content-Type": "text/plain"})
 
     team_id = data.get("team_id")
-    bot_token = redis.get(f"token:{team_id}")
-    if not bot_token:
-        bot_token = SLACK_TOKEN  # fallback to static token
-        print(f"[WARN] No stored bot token for team_id={team_id}. Using fallback SLACK_TOKEN.")
-    if isinstance(bot_token, bytes):
-        bot_token = bot_token.decode()
-
     event = data.get("event", {})
     event_id = data.get("event_id")
     user_id = event.get("user")
     event_type = event.get("type")
     subtype = event.get("subtype")
 
-    if event_id in processed_event_ids:
+    # Bloom filter is the in-process fast path; the Redis SET NX is the
+    # authoritative check that survives restarts.
+    if event_id:
+        with SEEN_LOCK:
+            duplicate = seen_events.add(event_id)
+        if duplicate:
+            return make_response("Duplicate", 200)
+
+    # One Upstash round-trip for dedupe + bot token + API key instead of
+    # three sequential HTTPS calls. The API-key GET is skipped entirely
+    # on a cache hit. Dedupe entries live in one hash per 5-minute
+    # bucket rather than one key per event, keeping the keyspace O(1);
+    # the previous bucket is checked too so retries that straddle a
+    # bucket boundary still count as duplicates.
+    api_key = None
+    if user_id:
+        with API_KEY_LOCK:
+            api_key = API_KEY_CACHE.get(user_id)
+    bucket = int(time.time()) // 300
+    pipeline = redis.pipeline()
+    pipeline.hsetnx(f"dedup:{bucket}", str(event_id), "1")
+    pipeline.hexists(f"dedup:{bucket - 1}", str(event_id))
+    pipeline.expire(f"dedup:{bucket}", 600)
+    pipeline.get(f"token:{team_id}")
+    if api_key is None:
+        pipeline.get(f"key:{user_id}")
+    results = pipeline.exec()
+    seen_is_new, seen_previous, bot_token = results[0], results[1], results[3]
+    if api_key is None:
+        api_key = results[4]
+
+    if event_id and (not seen_is_new or seen_previous):
         return make_response("Duplicate", 200)
-    processed_event_ids.add(event_id)
+
+    if not bot_token:
+        bot_token = SLACK_TOKEN  # fallback to static token
+        logger.warning("[WARN] No stored bot token for team_id=%s. Using fallback SLACK_TOKEN.", team_id)
+    if isinstance(bot_token, bytes):
+        bot_token = bot_token.decode('ascii')
 
     if event_type == "message" and subtype == "file_share":
         if "bot_id" in event:
             return make_response("Ignore bot", 200)
-
-        api_key = redis.get(f"key:{user_id}")
         if api_key is None:
             warn_key = f"warned:{user_id}:{event.get('ts')}"
-            if not redis.get(warn_key):
-                redis.set(warn_key, "1", ex=3600)
-                print(f"[WARN] No API key for user: {user_id}")
+            if redis.set(warn_key, "1", nx=True, ex=3600):
+                logger.warning("[WARN] No API key for user: %s", user_id)
                 post_to_slack(event.get("channel"), event.get("ts"),
                     ":warning: You haven’t set your Tiliter API key yet.\n\nVisit https://ai.vision.tiliter.com to purchase credits, then use `/set-apikey YOUR_KEY` to activate.",
                     bot_token
@@ -121,14 +209,15 @@ def slack_events():
             return make_response("No API key", 200)
 
         if isinstance(api_key, bytes):
-            api_key = api_key.decode()
+            api_key = api_key.decode('ascii')
+        with API_KEY_LOCK:
+            API_KEY_CACHE[user_id] = api_key
 
         for file in event.get("files", []):
-            if file.get("mimetype", "").startswith("image/"):
-                print(f"[EVENT] Image upload received by user {user_id} in channel {event.get('channel')}")
-                image_url = file["url_private"]
-                result = handle_image(image_url, api_key, bot_token)
-                post_to_slack(event["channel"], event["ts"], result, bot_token)
+            mimetype = file.get("mimetype")
+            if mimetype and mimetype.startswith(_IMAGE_PREFIX):
+                logger.info("[EVENT] Image upload received by user %s in channel %s", user_id, event.get("channel"))
+                EXECUTOR.submit(_process_and_post, file["url_private"], event["channel"], event["ts"], api_key, bot_token, mimetype)
 
     return make_response("OK", 200)
 
@@ -143,18 +232,20 @@ def set_api_key():
         return make_response("Usage: /set-apikey YOUR_KEY", 200)
 
     redis.set(f"key:{user_id}", text)
-    print(f"[METRIC] API key SET for user: {user_id}")
+    with API_KEY_LOCK:
+        API_KEY_CACHE[user_id] = text
+    logger.info("[METRIC] API key SET for user: %s", user_id)
     return make_response("✅ Tiliter API key saved successfully.", 200)
 
 @app.route("/get-apikey", methods=["POST"])
 def get_api_key():
     verify_slack_request(request)
     user_id = request.form.get("user_id")
-    print(f"[METRIC] API key GET for user: {user_id}")
+    logger.info("[METRIC] API key GET for user: %s", user_id)
     api_key = redis.get(f"key:{user_id}")
     if api_key:
         if isinstance(api_key, bytes):
-            api_key = api_key.decode()
+            api_key = api_key.decode('ascii')
         return make_response(f"🔐 Your current API key is:\n```{api_key}```", 200)
     return make_response("❌ No API key set.", 200)
 
@@ -163,34 +254,79 @@ def delete_api_key():
     verify_slack_request(request)
     user_id = request.form.get("user_id")
     redis.delete(f"key:{user_id}")
-    print(f"[METRIC] API key DELETE for user: {user_id}")
+    with API_KEY_LOCK:
+        API_KEY_CACHE.pop(user_id, None)
+    logger.info("[METRIC] API key DELETE for user: %s", user_id)
     return make_response("🗑️ Tiliter API key removed.", 200)
 
-def handle_image(image_url, api_key, bot_token):
-    print("⬇️ Downloading image from Slack...")
-    image_response = requests.get(image_url, headers={'Authorization': f'Bearer {bot_token}'})
-    if image_response.status_code != 200:
-        print(f"[ERROR] Failed to download image from Slack. Status: {image_response.status_code}")
-        return f":x: Failed to download image. Status: {image_response.status_code}"
-
-    image_b64 = base64.b64encode(image_response.content).decode('utf-8')
-    payload = { "image_data": f"data:image/jpeg;base64,{image_b64}" }
-
-    print("📤 Sending to Tiliter API...")
-    response = requests.post(
+def _process_and_post(image_url, channel, thread_ts, api_key, bot_token, mimetype=None):
+    try:
+        result = handle_image(image_url, api_key, bot_token, mimetype)
+        post_to_slack(channel, thread_ts, result, bot_token)
+    except Exception:
+        logger.exception("[ERROR] Unhandled exception processing image")
+
+# Tokens are per-team and API keys per-user, so the header dicts cannot
+# be module constants; caching per token still avoids rebuilding them on
+# every call.
+@lru_cache(maxsize=256)
+def _slack_auth_headers(bot_token):
+    return {'Authorization': f'Bearer {bot_token}'}
+
+@lru_cache(maxsize=256)
+def _slack_json_headers(bot_token):
+    return {'Authorization': f'Bearer {bot_token}', 'Content-Type': 'application/json'}
+
+@lru_cache(maxsize=256)
+def _tiliter_headers(api_key):
+    return {'X-API-Key': api_key, 'Content-Type': 'application/json'}
+
+def _sniff_mimetype(image_bytes):
+    if image_bytes[:3] == b'\xff\xd8\xff':
+        return "image/jpeg"
+    if image_bytes[:4] == b'\x89PNG':
+        return "image/png"
+    if image_bytes[:4] == b'RIFF' and image_bytes[8:12] == b'WEBP':
+        return "image/webp"
+    return "image/jpeg"
+
+def handle_image(image_url, api_key, bot_token, mimetype=None):
+    logger.info("⬇️ Downloading image from Slack...")
+    # The with block closes the streamed response on every path so its
+    # connection always returns to the pool.
+    with SESSION.get(image_url, headers=_slack_auth_headers(bot_token), stream=True, timeout=HTTP_TIMEOUT) as image_response:
+        if image_response.status_code != 200:
+            logger.error("[ERROR] Failed to download image from Slack. Status: %s", image_response.status_code)
+            return f":x: Failed to download image. Status: {image_response.status_code}"
+
+        image_bytes = bytearray()
+        for chunk in image_response.iter_content(chunk_size=57 * 1024):
+            image_bytes += chunk
+
+    if not mimetype:
+        mimetype = _sniff_mimetype(image_bytes)
+
+    # Base64 output never needs JSON escaping, so the payload can be
+    # assembled at the bytes layer without an image-sized str copy.
+    prefix = f'{{"image_data":"data:{mimetype};base64,'.encode('ascii')
+    payload = prefix + pybase64.b64encode(image_bytes) + b'"}'
+
+    logger.info("📤 Sending to Tiliter API...")
+    response = SESSION.post(
         TILITER_URL,
-        headers={'X-API-Key': api_key, 'Content-Type': 'application/json'},
-        json=payload
+        headers=_tiliter_headers(api_key),
+        data=payload,
+        timeout=HTTP_TIMEOUT
     )
 
     if response.status_code != 200:
-        print(f"[ERROR] Tiliter API error {response.status_code}: {response.text}")
+        logger.error("[ERROR] Tiliter API error %s: %s", response.status_code, response.text)
         return f":x: Tiliter API error {response.status_code}: {response.text}"
 
     try:
-        result = response.json().get("result", {})
-        print("✅ Tiliter API response:")
-        print(json.dumps(result, indent=2))
+        result = orjson.loads(response.content).get("result", {})
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("✅ Tiliter API response:\n%s", orjson.dumps(result, option=orjson.OPT_INDENT_2).decode())
 
         merchant = result.get("merchant", "Unknown")
         total = result.get("total", "N/A")
@@ -198,38 +334,39 @@ def handle_image(image_url, api_key, bot_token):
         address = result.get("address", "")
         currency = result.get("currency", "")
 
+        lines = [
+            ":receipt: *Receipt Details:*",
+            f"- Merchant: *{merchant}*",
+            f"- Date: *{date}*",
+            f"- Total: *{total}{currency}*",
+            f"- Address: {address}",
+            "",
+            ":shopping_trolley: *Items:*",
+        ]
         items = result.get("items", [])
         if not items:
-            item_lines = "_No items detected._"
+            lines.append("_No items detected._")
         else:
-            item_lines = "\n".join([f"• {item.get('name', 'Unnamed')} — {item.get('price', 'N/A')}{currency}" for item in items])
-
-        return (
-            f":receipt: *Receipt Details:*\n"
-            f"- Merchant: *{merchant}*\n"
-            f"- Date: *{date}*\n"
-            f"- Total: *{total}{currency}*\n"
-            f"- Address: {address}\n\n"
-            f":shopping_trolley: *Items:*\n{item_lines}"
-        )
+            lines.extend(f"• {item.get('name', 'Unnamed')} — {item.get('price', 'N/A')}{currency}" for item in items)
+        return "\n".join(lines)
     except Exception as e:
-        print(f"[ERROR] Exception in parsing Tiliter response: {str(e)}")
+        logger.error("[ERROR] Exception in parsing Tiliter response: %s", str(e))
         return f":x: Could not parse Tiliter response:\n{str(e)}"
 
 def post_to_slack(channel, thread_ts, message, bot_token):
-    res = requests.post(
+    res = SESSION.post(
         'https://slack.com/api/chat.postMessage',
-        headers={
-            'Authorization': f'Bearer {bot_token}',
-            'Content-Type': 'application/json'
-        },
-        json={
+        headers=_slack_json_headers(bot_token),
+        data=orjson.dumps({
             'channel': channel,
             'thread_ts': thread_ts,
             'text': message
-        }
+        }),
+        timeout=HTTP_TIMEOUT
     )
-    print("🔁 Slack API response:", res.status_code, res.text)
+    logger.debug("🔁 Slack API response: %s %s", res.status_code, res.text)
 
 if __name__ == "__main__":
+    # Local development only; production runs under gunicorn (see
+    # gunicorn.conf.py / render.yaml).
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))